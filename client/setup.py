@@ -1,6 +1,9 @@
+import functools
+import hashlib
 import os
 from setuptools import setup
 from setuptools.command.build_py import build_py
+from setuptools.command.sdist import sdist
 import pkg_resources
 import re
 
@@ -30,12 +33,68 @@ def find_version():
     raise RuntimeError("Unable to find version string.")
 
 
+PROTO_HASH_FILE = os.path.join(DIR, "src", PKG_NAME, "pb", ".proto_hash")
+
+
+@functools.lru_cache(maxsize=None)
+def generator_version():
+    """Returns the versions of the toolchain generating the stubs, which they depend on.
+
+    Only called when a proto file is available, i.e. when stubs may have to be generated.
+    """
+    grpc_tools_version = pkg_resources.get_distribution("grpcio-tools").version
+    protobuf_version = pkg_resources.get_distribution("protobuf").version
+    return f"grpcio-tools=={grpc_tools_version} protobuf=={protobuf_version}"
+
+
+def proto_hash(file):
+    h = hashlib.sha256(generator_version().encode())
+    with open(os.path.join(PROTO_PATH, file), "rb") as f:
+        h.update(f.read())
+    return h.hexdigest()
+
+
+def read_proto_hashes():
+    """Returns the hashes of the proto files the current stubs were generated from."""
+    if not os.path.exists(PROTO_HASH_FILE):
+        return {}
+    with open(PROTO_HASH_FILE) as f:
+        return dict(reversed(line.split()) for line in f if line.strip())
+
+
+def stub_outdated(file, hashes):
+    """Returns whether the generated modules of a proto file are missing or were generated
+    from a different version of it or by a different toolchain."""
+    name = os.path.splitext(file)[0]
+    for suffix in ["_pb2.py", "_pb2_grpc.py"]:
+        if not os.path.exists(os.path.join(DIR, "src", PKG_NAME, "pb", name + suffix)):
+            return True
+    # Protos are not shipped in source distributions, their stubs are
+    if not os.path.exists(os.path.join(PROTO_PATH, file)):
+        return False
+    return hashes.get(file) != proto_hash(file)
+
+
 def generate_stub():
+    hashes = read_proto_hashes()
+    files = [file for file in PROTO_FILES if stub_outdated(file, hashes)]
+    if len(files) == 0:
+        return
+
+    missing = [
+        file for file in files if not os.path.exists(os.path.join(PROTO_PATH, file))
+    ]
+    if len(missing) > 0:
+        print(
+            f"Proto files {', '.join(missing)} not found in {PROTO_PATH}. Cannot continue."
+        )
+        exit(1)
+
     import grpc_tools.protoc
 
     proto_include = pkg_resources.resource_filename("grpc_tools", "_proto")
 
-    for file in PROTO_FILES:
+    for file in files:
         print(PROTO_PATH, file)
         res = grpc_tools.protoc.main(
             [
@@ -50,6 +109,10 @@ def generate_stub():
         if res != 0:
             print(f"Proto file generation failed. Cannot continue. Error code: {res}")
             exit(1)
+        hashes[file] = proto_hash(file)
+
+    with open(PROTO_HASH_FILE, "w") as f:
+        f.writelines(f"{digest}  {file}\n" for file, digest in sorted(hashes.items()))
 
 
 class BuildPackage(build_py):
@@ -58,28 +121,36 @@ class BuildPackage(build_py):
         super(BuildPackage, self).run()
 
 
+class SourcePackage(sdist):
+    # Source distributions ship the stubs instead of the protos, which live outside of the package
+    def run(self):
+        generate_stub()
+        super(SourcePackage, self).run()
+
+
 setup(
     name=PKG_NAME,
     version=find_version(),
     description="Client for BastionLab Confidential Analytics.",
     long_description_content_type="text/markdown",
     keywords="confidential computing training client enclave amd-sev machine learning",
-    cmdclass={"build_py": BuildPackage},
+    cmdclass={"build_py": BuildPackage, "sdist": SourcePackage},
+    include_package_data=True,
+    package_data={PKG_NAME: ["pb/*.py"]},
     long_description=LONG_DESCRIPTION,
     author="Kwabena Amponsem, Lucas Bourtoule",
     author_email="kwabena.amponsem@mithrilsecurity.io, luacs.bourtoule@nithrilsecurity.io",
     classifiers=["Programming Language :: Python :: 3"],
     install_requires=[
         "polars==0.14.24",
-        "torch==1.13.1",
+        "torch>=2.1",
         "typing-extensions~=4.4",
-        "grpcio==1.47.0",
-        "grpcio-tools==1.47.0",
+        "grpcio>=1.51.1",
         "colorama~=0.4.6",
         "cryptography~=38.0",
         "seaborn~=0.12.0",
         "pyarrow~=10.0",
-        "protobuf==3.20.2",
+        "protobuf~=4.21",
         "six~=1.16.0",
         "numpy~=1.21",
         "tqdm~=4.64",
@@ -1,6 +1,11 @@
 import os
 import sys
 
+# Prefers the native (upb) protobuf backend
+# This must happen before any generated module is imported
+# (PROTOCOL_BUFFERS_PYTHON_IMPLEMENTATION=cpp may be used with protobuf builds lacking upb)
+os.environ.setdefault("PROTOCOL_BUFFERS_PYTHON_IMPLEMENTATION", "upb")
+
 # Makes generated grpc modules visible
 # Needed because internal imports within generated modules are relative
 sys.path.append(os.path.join(os.path.dirname(__file__), "pb"))
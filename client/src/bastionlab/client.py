@@ -23,6 +23,10 @@ if TYPE_CHECKING:
 
 __pdoc__ = {}
 
+# Chunks of data exchanged with the server are close to gRPC's default 4MB limit,
+# which the headers of the first chunk of a stream (name, description...) may exceed
+MAX_MESSAGE_LENGTH = 64 * 1024 * 1024
+
 
 class AuthPlugin(grpc.AuthMetadataPlugin):
     client: Optional["Client"] = None
@@ -259,7 +263,11 @@ class Connection:
         server_creds = grpc.ssl_channel_credentials(
             root_certificates=bytes(server_cert, encoding="utf8")
         )
-        connection_options = (("grpc.ssl_target_name_override", self._server_name),)
+        connection_options = (
+            ("grpc.ssl_target_name_override", self._server_name),
+            ("grpc.max_send_message_length", MAX_MESSAGE_LENGTH),
+            ("grpc.max_receive_message_length", MAX_MESSAGE_LENGTH),
+        )
 
         # Verify user by creating session
         self._token = Connection._verify_user(
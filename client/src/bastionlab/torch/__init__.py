@@ -1,3 +1,12 @@
+import warnings
+import torch
+
+# TensorDataset batches rely on DataLoader calling Dataset.__getitems__ (recent torch releases)
+if torch.__version__ < "2.1":
+    warnings.warn(
+        f"bastionlab.torch requires torch>=2.1 (found {torch.__version__}), please upgrade torch."
+    )
+
 __pdoc__ = {}
 
 from .client import BastionLabTorch
@@ -1,129 +1,216 @@
 import io
-from typing import Callable, Iterator, List, Tuple, TypeVar, Optional, Any
+import functools
+import queue
+import struct
+import threading
+import warnings
+from itertools import chain
+from types import MappingProxyType
+from typing import Callable, Hashable, Iterator, List, Tuple, TypeVar, Optional, Any
+from weakref import WeakKeyDictionary
 import torch
 from torch import Tensor
 from torch.nn import Module
-from torch.nn.parameter import Parameter
-from torch.utils.data import Dataset
+from torch.utils.data import DataLoader, Dataset, IterableDataset
 from tqdm import tqdm  # type: ignore [import]
-from ..pb.bastionlab_torch_pb2 import Chunk  # type: ignore [import]
+from ..pb.bastionlab_torch_pb2 import Batch, Chunk, TensorBuffer  # type: ignore [import]
 from ..pb.bastionlab_pb2 import Reference
-from .utils import TensorDataset
+from .utils import TensorBatch, TensorDataset
 
 T = TypeVar("T")
-U = TypeVar("U")
-SIZE_LEN = 8
-
-
-class DataWrapper(Module):
-    """Wrapps data in a (dummy) module to be able to retrieve them through libtorch on the server.
-
-    Args:
-        columns: Tensors that represent the clolumns of the dataset (a column contains the values
-        for a given input for all samples).
-        labels: A tensor containing the labels of all inputs.
-        privacy_limit: Maximum privacy budget that can be expanded on these data.
-    """
-
-    def __init__(
-        self,
-        columns: List[Tensor],
-        labels: Optional[Tensor],
-        privacy_limit: Optional[float] = None,
-    ) -> None:
-        super().__init__()
-        for i, column in enumerate(columns):
-            self.__setattr__(f"samples_{i}", Parameter(column, requires_grad=False))
-        if labels is not None:
-            self.labels = Parameter(labels, requires_grad=False)
-        self.privacy_limit = Parameter(
-            torch.tensor([privacy_limit if privacy_limit is not None else -1.0])
-        )
-
-
-def data_from_wrapper(wrapper: DataWrapper) -> Tuple[List[Tensor], Optional[Tensor]]:
-    """Converts a data wrapper into a list of columns and labels."""
-    opt_columns: List[Optional[Tensor]] = []
-    labels: Optional[Tensor] = None
-    for name, param in wrapper.named_parameters():
-        if name == "labels":
-            labels = param
-        elif name.startswith("samples_"):
-            idx = int(name[8:])
-            print(idx)
-            if len(opt_columns) <= idx:
-                opt_columns += [None] * (idx + 1 - len(opt_columns))
-            opt_columns[idx] = param
-        else:
-            if name not in ["privacy_limit"]:
-                raise Exception(f"Unknown field {name} in data wrapper")
-    if len(opt_columns) == 0:
-        raise Exception(f"Data wrapper must contain at least one column.")
-    if any([x is None for x in opt_columns]):
-        raise Exception(f"Missing column in data wrapper.")
-    columns: List[Tensor] = [x for x in opt_columns if x is not None]
-
-    return (columns, labels)
+# Serialized objects are prefixed with their length as a little-endian u64
+SIZE_STRUCT = struct.Struct("<Q")
+SIZE_LEN = SIZE_STRUCT.size
+
+# Names of the tch::Kind matching torch dtypes (as parsed by the server)
+TCH_KINDS = MappingProxyType(
+    {
+        torch.uint8: "Uint8",
+        torch.int8: "Int8",
+        torch.int16: "Int16",
+        torch.int32: "Int",
+        torch.int64: "Int64",
+        torch.half: "Half",
+        torch.float: "Float",
+        torch.double: "Double",
+        torch.complex32: "ComplexHalf",
+        torch.complex64: "ComplexFloat",
+        torch.complex128: "ComplexDouble",
+        torch.bool: "Bool",
+        torch.qint8: "QInt8",
+        torch.quint8: "QUInt8",
+        torch.qint32: "QInt32",
+        torch.bfloat16: "BFloat16",
+    }
+)
+# Torch dtypes matching the names of tch::Kind (including the aliases parsed by the server)
+TORCH_DTYPES = MappingProxyType(
+    {
+        "Uint8": torch.uint8,
+        "Int8": torch.int8,
+        "Int16": torch.int16,
+        "Int": torch.int32,
+        "Int64": torch.int64,
+        "Half": torch.half,
+        "Float": torch.float,
+        "Float32": torch.float32,
+        "Float64": torch.float64,
+        "Double": torch.double,
+        "ComplexHalf": torch.complex32,
+        "ComplexFloat": torch.complex64,
+        "ComplexDouble": torch.complex128,
+        "Bool": torch.bool,
+        "QInt8": torch.qint8,
+        "QUInt8": torch.quint8,
+        "QInt32": torch.qint32,
+        "BFloat16": torch.bfloat16,
+    }
+)
+
+# Compiled versions of the models already uploaded, along with the key they were compiled for.
+# Entries are released along with the models and dropped when their weights are replaced.
+compiled_models: "WeakKeyDictionary[Module, Tuple[Hashable, torch.jit.ScriptModule]]" = (
+    WeakKeyDictionary()
+)
 
 
 def dataset_from_chunks(chunks: Iterator[Chunk]) -> TensorDataset:
     """Builds a `TensorDataset` from a chunks iterator (returned by the underlying gRPC protocol)."""
-    wrappers = unstream_artifacts(
-        (chunk.data for chunk in chunks), deserialization_fn=torch.jit.load
+    batches = list(
+        unstream_artifacts(
+            (chunk.data for chunk in chunks),
+            deserialization_fn=lambda b: Batch.FromString(b.getbuffer()),
+        )
     )
-
-    data = [data_from_wrapper(wrapper) for wrapper in wrappers]
-
-    columns = [torch.cat([x[i] for x, _ in data]) for i in range(len(data[0][0]))]
+    if len(batches) == 0:
+        raise Exception("Received dataset is empty.")
+
+    # Each batch is copied out of the stream buffer, then by the protobuf parser (and
+    # possibly again when its data fields are read). Tensors alias the bytes of those
+    # fields, so concatenating them only adds one more copy.
+    columns = [
+        torch.cat([tensor_from_buffer(batch.columns[i]) for batch in batches])
+        for i in range(len(batches[0].columns))
+    ]
     labels = (
-        torch.cat([y for _, y in data if y is not None])
-        if data[0][1] is not None
+        torch.cat([tensor_from_buffer(batch.labels) for batch in batches])
+        if batches[0].HasField("labels")
         else None
     )
 
     return TensorDataset(columns, labels)
 
 
-def id(l: List[T], _: Optional[U] = None) -> U:
-    """Identity functions. Here for type checking."""
-    res: U = l  # type: ignore [assignment]
-    return res
+def prefetch(it: Iterator[T], size: int = 4) -> Iterator[T]:
+    """Consumes an iterator in a background thread, keeping up to `size` elements ready in advance.
 
-
-def chunks(
-    it: Iterator[T], chunk_size: int, cat_fn: Callable[[List[T]], U] = id
-) -> Iterator[U]:
-    """Groups elements of an iterator by chunks.
+    Exceptions raised by the underlying iterator are re-raised in the consuming thread.
 
     Args:
         it: input iterator.
-        chunk_size: size of the chunks.
-        cat_fn: aggregation function called on every chunk.
+        size: maximum number of elements produced in advance.
     """
-    chunk: List[T] = []
-    for x in it:
-        if len(chunk) == chunk_size:
-            yield cat_fn(chunk)
-            chunk = [x]
+    # Items are (done, value) pairs, the last one carries the exception raised, if any
+    items: "queue.Queue[Tuple[bool, Any]]" = queue.Queue(maxsize=size)
+    stopped = threading.Event()
+
+    def put(item: Tuple[bool, Any]) -> bool:
+        while not stopped.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce() -> None:
+        try:
+            for x in it:
+                if not put((False, x)):
+                    return
+        except Exception as e:
+            put((True, e))
         else:
-            chunk.append(x)
-    if len(chunk) > 0:
-        yield cat_fn(chunk)
+            put((True, None))
+
+    threading.Thread(target=produce, daemon=True).start()
+    try:
+        while True:
+            done, x = items.get()
+            if done:
+                if x is not None:
+                    raise x
+                return
+            yield x
+    finally:
+        stopped.set()
+
+
+def tensor_to_buffer(tensor: Tensor) -> TensorBuffer:
+    """Converts a tensor into a BastionAI gRPC protocol `TensorBuffer` holding its raw data, shape and dtype."""
+    tensor = tensor.detach().cpu().contiguous()
+    return TensorBuffer(
+        data=tensor.reshape(-1).view(torch.uint8).numpy().tobytes(),
+        shape=tensor.shape,
+        dtype=TCH_KINDS[tensor.dtype],
+    )
+
+
+def tensor_from_buffer(buffer: TensorBuffer) -> Tensor:
+    """Builds a tensor from a `TensorBuffer` message, aliasing the bytes of its data field.
+
+    The returned tensor shares memory with the (read-only) message and must not be
+    written to.
+    """
+    dtype = TORCH_DTYPES.get(buffer.dtype)
+    if dtype is None:
+        raise Exception(f"Unsupported dtype {buffer.dtype}.")
+    # Accessing the field may copy the bytes (e.g. with the upb backend), it is only done once
+    data = buffer.data
+    if len(data) == 0:
+        return torch.empty(tuple(buffer.shape), dtype=dtype)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", UserWarning)
+        tensor = torch.frombuffer(data, dtype=dtype)
+    return tensor.reshape(tuple(buffer.shape))
 
 
 def serialize_batch(
     privacy_limit: Optional[float] = None,
-) -> Callable[[Tuple[List[Tensor], Tensor], io.BytesIO], None]:
-    """Serializes a batch of data by wrapping it in a `DataWrapper` module, using torch.jit utility functions and
-    writes the output to the given buffer.
+) -> Callable[[Tuple[List[Tensor], Optional[Tensor]], io.BytesIO], None]:
+    """Serializes a batch of data into a BastionAI gRPC protocol `Batch` message made of raw
+    tensor buffers and writes the output to the given buffer.
     """
 
-    def inner(data: Tuple[List[Tensor], Tensor], buff: io.BytesIO) -> None:
-        torch.jit.save(torch.jit.script(DataWrapper(*data, privacy_limit)), buff)
+    def inner(data: Tuple[List[Tensor], Optional[Tensor]], buff: io.BytesIO) -> None:
+        columns, labels = data
+        batch = Batch(
+            columns=[tensor_to_buffer(column) for column in columns],
+            labels=tensor_to_buffer(labels) if labels is not None else None,
+            privacy_limit=privacy_limit if privacy_limit is not None else -1.0,
+        )
+        buff.write(batch.SerializeToString())
 
     return inner
 
 
+def collate_serialized_batch(
+    data: List[Tuple[List[Tensor], Tensor]], privacy_limit: Optional[float] = None
+) -> bytes:
+    """Aggregates a group of samples into a batch and returns its serialized `Batch` message.
+
+    Used as the `collate_fn` of loaders whose batches are serialized in worker processes.
+    """
+    buff = io.BytesIO()
+    serialize_batch(privacy_limit)(make_batch(data), buff)
+    return buff.getvalue()
+
+
+def write_serialized(data: bytes, buff: io.BytesIO) -> None:
+    """Writes already serialized bytes to the given buffer."""
+    buff.write(data)
+
+
 def stream_artifacts(
     artifacts: Iterator[T],
     chunk_size: int,
@@ -136,34 +223,21 @@ def stream_artifacts(
         chunk_size: Size of the bytes chunks.
         serialization_fn: Function used to convert an object into bytes and write these bytes to a buffer.
     """
-    eoi = False
-    buff = io.BytesIO()
-    while not eoi:
-        while buff.tell() < chunk_size:
-            try:
-                artifact = artifacts.__next__()
-                header = buff.tell()
-                buff.write(b"\xde\xad\xbe\xef\xde\xad\xbe\xef")
-                serialization_fn(artifact, buff)
-                end = buff.tell()
-                buff.seek(header)
-                buff_len = (end - header - SIZE_LEN).to_bytes(
-                    SIZE_LEN, byteorder="little"
-                )
-                buff.write(buff_len)
-                buff.seek(end)
-            except StopIteration:
-                eoi = True
-                break
-        position = buff.tell()
-        buff.seek(0)
-        if eoi:
-            yield (position, buff.read(position))
-        else:
-            yield (position, buff.read(chunk_size))
-            tail = buff.read(position - chunk_size)
-            buff.seek(0)
-            buff.write(tail)
+    buff = bytearray()
+    for artifact in artifacts:
+        artifact_buff = io.BytesIO()
+        serialization_fn(artifact, artifact_buff)
+        header = len(buff)
+        buff += b"\x00" * SIZE_LEN
+        buff += artifact_buff.getbuffer()
+        SIZE_STRUCT.pack_into(buff, header, len(buff) - header - SIZE_LEN)
+        # Only the bytes in excess of the emitted chunks are moved, once per chunk
+        while len(buff) >= chunk_size:
+            with memoryview(buff) as view:
+                chunk = bytes(view[:chunk_size])
+            yield (len(buff), chunk)
+            del buff[:chunk_size]
+    yield (len(buff), bytes(buff))
 
 
 def unstream_artifacts(
@@ -173,33 +247,26 @@ def unstream_artifacts(
 
     Args:
         stream: Iterator of bytes chunks.
-    """
-    buff = io.BytesIO()
-    init_chunk = stream.__next__()
-    size = int.from_bytes(init_chunk[:8], "little")
-    buff.write(init_chunk[8:])
-    eoi = False
 
-    while not eoi:
-        while buff.tell() < size + 4:
-            try:
-                buff.write(stream.__next__())
-            except StopIteration:
-                buff.seek(0)
-                yield deserialization_fn(buff)
-                eoi = True
-                break
-
-        if not eoi:
-            end = buff.tell()
-            buff.seek(size)
-            header = buff.read(SIZE_LEN)
-            size = int.from_bytes(header, "little")
-            tail = buff.read(end - size - SIZE_LEN)
-            buff.seek(0)
-            yield deserialization_fn(buff)
-            buff.seek(0)
-            buff.write(tail)
+    Raises:
+        ValueError: if the stream ends in the middle of an object.
+    """
+    buff = bytearray()
+    for chunk in stream:
+        buff += chunk
+        start = 0
+        with memoryview(buff) as view:
+            while len(buff) - start >= SIZE_LEN:
+                (size,) = SIZE_STRUCT.unpack_from(view, start)
+                end = start + SIZE_LEN + size
+                if len(buff) < end:
+                    break
+                yield deserialization_fn(io.BytesIO(view[start + SIZE_LEN : end]))
+                start = end
+        # Consumed objects are dropped once per received chunk
+        del buff[:start]
+    if len(buff) > 0:
+        raise ValueError("truncated stream")
 
 
 def data_chunks_generator(
@@ -220,9 +287,6 @@ def data_chunks_generator(
     last_estimate = 0
     t = None
     for estimate, x in stream:
-        # print(estimate)
-        # print(f"{chunk_size} > {estimate}")
-
         if progress and estimate > last_estimate:
             if t is not None:
                 t.total = t.n + estimate
@@ -240,7 +304,8 @@ def data_chunks_generator(
             first = False
             yield Chunk(data=x, name=name, description=description, meta=meta)
         else:
-            yield Chunk(data=x, name=name, description="", meta=bytes())
+            # Empty fields are not sent, only the first chunk carries the header
+            yield Chunk(data=x)
 
         if progress and t is not None:
             t.update(len(x))
@@ -249,28 +314,43 @@ def data_chunks_generator(
 
 def make_batch(data: List[Tuple[List[Tensor], Tensor]]) -> Tuple[List[Tensor], Tensor]:
     """Aggregates a group of lists of column tensors and label tensors."""
+    if isinstance(data, TensorBatch):
+        # Already gathered by TensorDataset.__getitems__
+        return (data.columns, data.labels)
+    samples, labels = zip(*data)
     return (
-        [torch.stack([x[0][i] for x in data]) for i in range(len(data[0][0]))],
-        torch.stack([x[1] for x in data])
-        if type(data[0][1]) == torch.Tensor
-        else torch.tensor([x[1] for x in data]),
+        [torch.stack(column) for column in zip(*samples)],
+        torch.stack(labels)
+        if isinstance(labels[0], torch.Tensor)
+        else torch.tensor(labels),
     )
 
 
+class _IterDataset(IterableDataset):
+    """Iterates over a dataset that does not define `__len__` (e.g. `__getitem__` until `IndexError`)."""
+
+    def __init__(self, dataset: Dataset) -> None:
+        self.dataset = dataset
+
+    def __iter__(self) -> Iterator[Any]:
+        return iter(self.dataset)
+
+
 def serialize_dataset(
     dataset: Dataset,
     name: str,
     description: str,
     privacy_limit: Optional[float] = None,
-    chunk_size: int = 100_000_000,
+    chunk_size: int = 4_194_285,
     batch_size: int = 1024,
     train_dataset: Optional[Reference] = None,
     progress: bool = False,
+    num_workers: int = 0,
 ) -> Iterator[Chunk]:
     """Coverts a dataset into an iterator of bytes chunks.
 
-    The dataset is processed one batch at a time. Each batch is wrapped in a `DataModuleWrapper`
-    and serialized using `torch.jit` utility functions.
+    The dataset is processed one batch at a time. Each batch is serialized as a `Batch`
+    message that holds the raw data of its tensors.
 
     Args:
         dataset: Dataset to be serialized.
@@ -280,12 +360,43 @@ def serialize_dataset(
         chunk_size: size of the bytes chunks sent over gRPC.
         batch_size: size of the batches (in number of samples) during the serialization step.
         train_dataset: metadata, True means this dataset is suited for training, False that it should be used for testing/validating only
+        num_workers: number of worker processes used to load and serialize the batches,
+                     0 means the batches are processed in the calling process.
+                     Datasets without `__len__` are always processed in the calling process.
     """
+    if not isinstance(dataset, IterableDataset) and not hasattr(dataset, "__len__"):
+        # DataLoader samples indices up to len(dataset): datasets without a length are
+        # iterated instead, in a single process so that their samples are not duplicated
+        dataset = _IterDataset(dataset)
+        num_workers = 0
+
+    collate_fn: Callable[[Any], Any]
+    serialization_fn: Callable[[Any, io.BytesIO], None]
+    if num_workers > 0:
+        # Batches are built and serialized in parallel by the worker processes,
+        # they only need to be framed in the calling process
+        collate_fn = functools.partial(
+            collate_serialized_batch, privacy_limit=privacy_limit
+        )
+        serialization_fn = write_serialized
+    else:
+        collate_fn = make_batch
+        serialization_fn = serialize_batch(privacy_limit)
+
+    loader = DataLoader(
+        dataset,
+        batch_size=batch_size,
+        collate_fn=collate_fn,
+        num_workers=num_workers,
+    )
     return data_chunks_generator(
-        stream_artifacts(
-            chunks(iter(dataset), batch_size, cat_fn=make_batch),
-            chunk_size,
-            serialization_fn=serialize_batch(privacy_limit),
+        # Batches are serialized in the background while previous chunks are being sent
+        prefetch(
+            stream_artifacts(
+                iter(loader),
+                chunk_size,
+                serialization_fn=serialization_fn,
+            )
         ),
         name=name,
         description=description,
@@ -298,7 +409,7 @@ def serialize_model(
     model: Module,
     name: str,
     description: str,
-    chunk_size: int = 100_000_000,
+    chunk_size: int = 4_194_285,
     progress: bool = False,
 ) -> Iterator[Chunk]:
     """Coverts a model into an iterator of bytes chunks.
@@ -331,45 +442,76 @@ def deserialize_weights_to_model(model: Module, chunks: Iterator[Chunk]) -> None
             (chunk.data for chunk in chunks), deserialization_fn=torch.jit.load
         )
     )[0]
-    for name, value in wrapper.named_parameters():
-        param = model
-        parent = None
-        segments = name.split("_")
-        name_buf = []
-        for segment in segments:
-            name_buf.append(segment)
-            name = "_".join(name_buf)
-            if hasattr(param, name):
-                parent = param
-                param = param.__getattr__(name)  # type: ignore [assignment]
-                name_buf = []
+    # Weights are named after their path in the model, with dots replaced by underscores
+    parents = {}
+    for module_name, module in model.named_modules():
+        prefix = module_name.replace(".", "_")
+        for attr, _ in chain(
+            module.named_parameters(recurse=False), module.named_buffers(recurse=False)
+        ):
+            parents[f"{prefix}_{attr}" if prefix else attr] = (module, attr)
 
-        parent.__setattr__(name, torch.nn.Parameter(value))
+    for name, value in wrapper.named_parameters():
+        if name not in parents:
+            raise Exception(f"Unknown weight {name} for the given model.")
+        parent, attr = parents[name]
+        parent.__setattr__(attr, torch.nn.Parameter(value))
+    # The compiled version of the model still holds the replaced weights
+    compiled_models.pop(model, None)
 
 
 def bulk_serialize(obj: Any) -> bytes:
     buff = io.BytesIO()
     torch.save(obj, buff)
-    buff.seek(0)
-    return buff.read()
+    return buff.getvalue()
 
 
 def bulk_deserialize(b: bytes) -> Any:
-    buff = io.BytesIO()
-    buff.write(b)
-    buff.seek(0)
-    return torch.load(buff)
+    # BytesIO shares the initial bytes object until it is written to
+    return torch.load(io.BytesIO(b))
 
 
-def send_tensor(
-    tensor: torch.Tensor, chunk_size: Optional[int] = 32
-) -> Iterator[Chunk]:
-    buf = io.BytesIO()
+def encode_varint(value: int) -> bytes:
+    """Encodes an unsigned integer as a protobuf varint."""
+    res = bytearray()
+    while value > 0x7F:
+        res.append((value & 0x7F) | 0x80)
+        value >>= 7
+    res.append(value)
+    return bytes(res)
+
 
-    torch.jit.save(torch.jit.script(DataWrapper([tensor], None)), buf)
-    buf.seek(0)
-    buf_len = len(buf.getvalue())
-    while buf.tell() < buf_len:
-        data = buf.read(chunk_size)
+def stream_tensor_buffer(tensor: Tensor, chunk_size: int) -> Iterator[bytes]:
+    """Converts a tensor into a length-prefixed `TensorBuffer` message split in bytes chunks.
+
+    The message is encoded by hand so that the raw data of the tensor is copied
+    one chunk at a time instead of being materialized in a single message.
+    """
+    tensor = tensor.detach().cpu().contiguous()
+    data = tensor.reshape(-1).view(torch.uint8).numpy()
+    # Fields may be encoded in any order: shape and dtype come first, followed by data
+    # (field 1, length-delimited wire type)
+    header = TensorBuffer(
+        shape=tensor.shape, dtype=TCH_KINDS[tensor.dtype]
+    ).SerializeToString()
+    header += b"\x0a" + encode_varint(len(data))
+    prefix = SIZE_STRUCT.pack(len(header) + len(data)) + header
 
-        yield Chunk(data=data, description="", meta=bytes(), name="", secret=bytes())
+    start = max(chunk_size - len(prefix), 0)
+    yield prefix + data[:start].tobytes()
+    for i in range(start, len(data), chunk_size):
+        yield data[i : i + chunk_size].tobytes()
+
+
+def send_tensor(tensor: torch.Tensor, chunk_size: int = 4_194_285) -> Iterator[Chunk]:
+    """Converts a tensor into an iterator of BastionAI gRPC protocol `Chunk` messages.
+
+    The raw data of the tensor is sent in a `TensorBuffer` message along with its shape and dtype.
+    Chunks are prepared in a background thread while the previous ones are being sent.
+
+    Args:
+        tensor: Tensor to be sent.
+        chunk_size: size of the bytes chunks sent over gRPC.
+    """
+    for data in prefetch(stream_tensor_buffer(tensor, chunk_size)):
+        yield Chunk(data=data)
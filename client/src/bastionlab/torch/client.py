@@ -1,4 +1,4 @@
-from typing import List, TYPE_CHECKING, Union, Optional
+from typing import Iterator, List, TYPE_CHECKING, Union, Optional
 from torch.nn import Module
 from torch.utils.data import Dataset
 import torch
@@ -81,6 +81,7 @@ class BastionLabTorch:
         batch_size: int = 1024,
         train_dataset: Optional[Reference] = None,
         progress: bool = False,
+        num_workers: int = 0,
     ) -> Reference:
         """Uploads a Pytorch Dataset to the BastionLab Torch server.
 
@@ -94,6 +95,9 @@ class BastionLabTorch:
                         at the price of a higher memory consumption.
             train_dataset: metadata, True means this dataset is suited for training,
                    False that it should be used for testing/validating only
+            num_workers: Number of worker processes used to load and serialize the batches
+                         (see `torch.utils.data.DataLoader`). The dataset must be picklable
+                         when this value is greater than 0.
 
         Returns:
             BastionLab Torch gRPC protocol's reference object.
@@ -112,6 +116,7 @@ class BastionLabTorch:
                     privacy_limit=privacy_limit,
                     train_dataset=train_dataset,
                     progress=progress,
+                    num_workers=num_workers,
                 )
             )
         )
@@ -249,6 +254,18 @@ class BastionLabTorch:
 
         return GRPCException._map_error(lambda: self.stub.GetMetric(run))
 
+    def stream_metric(self, run: Reference) -> Iterator[Metric]:
+        """Returns an iterator over the values of the metric associated with the given `run` reference,
+        as they are produced by the server. The iterator ends with the last batch of the run.
+
+        Args:
+            run: BastionLab Torch gRPC protocol reference of the run whose metric is read.
+        """
+
+        self.client._refresh_session_if_needed()
+
+        return GRPCException._map_error(lambda: self.stub.StreamMetric(run))
+
     def RemoteDataset(self, *args, **kwargs) -> "bastionlab.torch.RemoteDataset":
         """Returns a RemoteDataset object encapsulating a training and testing dataloaders
         on the remote server that uses this client to communicate with the server.
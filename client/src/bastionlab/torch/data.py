@@ -1,14 +1,18 @@
+import json
 import torch
-from typing import TYPE_CHECKING, List, Optional, Any
+from typing import Dict, List, Optional, Tuple, Any
 from dataclasses import dataclass
-from ._utils import send_tensor
-from ..pb.bastionlab_torch_pb2 import UpdateTensor, RemoteDatasetReference
-from ..pb.bastionlab_pb2 import Reference
+from ._utils import TCH_KINDS, TORCH_DTYPES, send_tensor
+from ..pb.bastionlab_torch_pb2 import (
+    UpdateTensor,
+    UpdateTensors,
+    RemoteDatasetReference,
+)
+from ..pb.bastionlab_torch_pb2_grpc import TorchServiceStub  # type: ignore [import]
 from torch.utils.data import Dataset
 from ..pb.bastionlab_pb2 import Reference, TensorMetaData
-
-if TYPE_CHECKING:
-    from .client import BastionLabTorch
+from ..client import Client
+from .client import BastionLabTorch
 
 
 @dataclass
@@ -21,6 +25,8 @@ class RemoteTensor:
     You can also change the dtype of the tensor through an API call
     """
 
+    __slots__ = ("_client", "_identifier", "_dtype", "_shape")
+
     _client: "BastionLabTorch"
     _identifier: str
     _dtype: torch.dtype
@@ -31,18 +37,34 @@ class RemoteTensor:
         return self._identifier
 
     def _serialize(self) -> Any:
-        return {"identifier": {self.identifier}}
+        return {"identifier": self.identifier}
 
     @staticmethod
     def _send_tensor(client: "BastionLabTorch", tensor: torch.Tensor) -> "RemoteTensor":
         res = client.stub.SendTensor(send_tensor(tensor))
-        dtype, shape = _get_tensor_metadata(res.meta)
-        return RemoteTensor(client, res.identifier, *dtype, *shape)
+        return RemoteTensor._from_reference(res, client)
 
     @staticmethod
-    def _from_reference(ref: Reference, client: "BastionLabTorch") -> "RemoteTensor":
-        dtypes, shape = _get_tensor_metadata(ref.meta)
-        return RemoteTensor(client, ref.identifier, dtypes[0], shape[0])
+    def _from_reference(
+        ref: Reference,
+        client: "BastionLabTorch",
+        dtype: Optional[torch.dtype] = None,
+        shape: Optional[torch.Size] = None,
+    ) -> "RemoteTensor":
+        if dtype is None or shape is None:
+            dtypes, shapes = _get_all_metadata([ref])
+            dtype, shape = dtypes[0], shapes[0]
+        return RemoteTensor(client, ref.identifier, dtype, shape)
+
+    @staticmethod
+    def _from_references(
+        refs: List[Reference], client: "BastionLabTorch"
+    ) -> List["RemoteTensor"]:
+        dtypes, shapes = _get_all_metadata(refs)
+        return [
+            RemoteTensor._from_reference(ref, client, dtype, shape)
+            for ref, dtype, shape in zip(refs, dtypes, shapes)
+        ]
 
     def __str__(self) -> str:
         return f"RemoteTensor(identifier={self._identifier}, dtype={self._dtype}, shape={self._shape})"
@@ -68,52 +90,65 @@ class RemoteTensor:
             dtype: torch.dtype
                 The resulting torch.dtype
         """
-        res = self._client.torch.stub.ModifyTensor(
-            UpdateTensor(identifier=self.identifier, dtype=tch_kinds[dtype])
-        )
+        res = _torch_stub(self._client).ModifyTensor(self._update(dtype))
         return RemoteTensor._from_reference(res, self._client)
 
+    def _update(self, dtype: torch.dtype) -> UpdateTensor:
+        return UpdateTensor(identifier=self.identifier, dtype=tch_kinds[dtype])
+
 
-torch_dtypes = {
-    "Int8": torch.uint8,
-    "UInt8": torch.uint8,
-    "Int16": torch.int16,
-    "Int32": torch.int32,
-    "Int64": torch.int64,
-    "Half": torch.half,
-    "Float": torch.float,
-    "Float32": torch.float32,
-    "Float64": torch.float64,
-    "Double": torch.double,
-    "ComplexHalf": torch.complex32,
-    "ComplexFloat": torch.complex64,
-    "ComplexDouble": torch.complex128,
-    "Bool": torch.bool,
-    "QInt8": torch.qint8,
-    "QInt32": torch.qint32,
-    "BFloat16": torch.bfloat16,
-}
-
-tch_kinds = {v: k for k, v in torch_dtypes.items()}
-
-
-def _get_tensor_metadata(meta_bytes: bytes):
+torch_dtypes = TORCH_DTYPES
+
+tch_kinds = TCH_KINDS
+
+
+def _torch_stub(client: Any) -> TorchServiceStub:
+    # RemoteTensors either hold the torch client or, when converted from polars,
+    # the polars client, which both hold the main client
+    if isinstance(client, BastionLabTorch):
+        return client.stub
+    if not isinstance(client, Client):
+        client = client.client
+    return client.torch.stub
+
+
+def _get_all_metadata(
+    refs: List[Reference],
+) -> Tuple[List[torch.dtype], List[torch.Size]]:
+    # A single message is reused to parse the metadata of all references
     meta = TensorMetaData()
-    meta.ParseFromString(meta_bytes)
+    dtypes = []
+    shapes = []
+    for ref in refs:
+        meta.Clear()
+        meta.MergeFromString(ref.meta)
+        dtypes.append(torch_dtypes[meta.input_dtype[0]])
+        shapes.append(torch.Size(meta.input_shape))
+    return dtypes, shapes
+
 
-    print(meta.input_dtype)
-    return [torch_dtypes[dt] for dt in meta.input_dtype], [
-        torch.Size(list(meta.input_shape))
-    ]
+_INT_DTYPES = frozenset(
+    {torch.uint8, torch.int8, torch.int16, torch.int32, torch.int64}
+)
 
 
 def _tracer(dtypes: List[torch.dtype], shapes: List[torch.Size]):
-    return [
-        torch.zeros(shape[-1], dtype=dtype)
-        if dtype in [torch.uint8, torch.int8, torch.int16, torch.int32, torch.int64]
-        else torch.randn(shape[-1], dtype=dtype)
-        for shape, dtype in zip(shapes, dtypes)
-    ]
+    # Integers are zeroed to remain valid indices (e.g. embeddings).
+    # Inputs sharing a dtype are split from a single allocation.
+    sizes = [shape[-1] for shape in shapes]
+    groups: Dict[torch.dtype, List[int]] = {}
+    for i, dtype in enumerate(dtypes):
+        groups.setdefault(dtype, []).append(i)
+
+    res: List[torch.Tensor] = [torch.empty(0)] * len(dtypes)
+    for dtype, indices in groups.items():
+        group_sizes = [sizes[i] for i in indices]
+        alloc = torch.zeros if dtype in _INT_DTYPES else torch.randn
+        for i, tensor in zip(
+            indices, alloc(sum(group_sizes), dtype=dtype).split(group_sizes)
+        ):
+            res[i] = tensor
+    return res
 
 
 def _make_id_reference(id: str) -> Reference:
@@ -160,7 +195,7 @@ class RemoteDataset:
             identifier=labels.identifier,
             description=description,
             name=name,
-            meta=bytes(f'{{"privacy_limit": {privacy_limit}}}', encoding="ascii"),
+            meta=json.dumps({"privacy_limit": privacy_limit}).encode("ascii"),
         )
 
         res = client.stub.ConvToDataset(
@@ -171,8 +206,9 @@ class RemoteDataset:
             )
         )
 
-        inputs = [RemoteTensor._from_reference(ref, client) for ref in res.inputs]
-        labels = RemoteTensor._from_reference(res.labels, client)
+        *inputs, labels = RemoteTensor._from_references(
+            [*res.inputs, res.labels], client
+        )
 
         return RemoteDataset(
             inputs,
@@ -188,8 +224,9 @@ class RemoteDataset:
         client: "BastionLabTorch", dataset: Dataset, *args, **kwargs
     ) -> "RemoteDataset":
         res: RemoteDatasetReference = client.send_dataset(dataset, *args, **kwargs)
-        inputs = [RemoteTensor._from_reference(ref, client) for ref in res.inputs]
-        labels = RemoteTensor._from_reference(res.labels, client)
+        *inputs, labels = RemoteTensor._from_references(
+            [*res.inputs, res.labels], client
+        )
 
         name = kwargs.get("name")
         description = kwargs.get("description")
@@ -204,6 +241,36 @@ class RemoteDataset:
             identifier=res.identifier,
         )
 
+    def to(
+        self, dtype: torch.dtype, labels_dtype: Optional[torch.dtype] = None
+    ) -> "RemoteDataset":
+        """
+        Performs dtype conversion of all the inputs (and optionally the labels)
+        of the dataset in a single API call.
+
+        Args:
+            dtype: torch.dtype
+                The resulting torch.dtype of the inputs
+            labels_dtype: Optional[torch.dtype] = None
+                The resulting torch.dtype of the labels, left unchanged if None
+        """
+        updates = [input._update(dtype) for input in self.inputs]
+        if labels_dtype is not None:
+            updates.append(self.labels._update(labels_dtype))
+
+        client = self.labels._client
+        res = _torch_stub(client).ModifyTensors(UpdateTensors(list=updates))
+        tensors = RemoteTensor._from_references(res.list, client)
+
+        return RemoteDataset(
+            tensors[: len(self.inputs)],
+            self.labels if labels_dtype is None else tensors[-1],
+            name=self.name,
+            description=self.description,
+            privacy_limit=self.privacy_limit,
+            identifier=self.identifier,
+        )
+
     def _serialize(self) -> Any:
         return {
             "inputs": [input._serialize() for input in self.inputs],
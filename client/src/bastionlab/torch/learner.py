@@ -1,7 +1,9 @@
-from typing import Optional, Union, List, Callable, TYPE_CHECKING
-from time import sleep
+from typing import Hashable, Optional, Union, List, Callable, TYPE_CHECKING
+from threading import Event, Thread
+from time import monotonic
+import warnings
 from tqdm import tqdm  # type: ignore [import]
-from grpc import StatusCode
+from grpc import RpcError
 from torch.nn import Module
 from torch.utils.data import Dataset
 import torch
@@ -10,6 +12,7 @@ from ..pb.bastionlab_pb2 import Reference
 from ..errors import GRPCException
 from .psg import expand_weights
 from .client import BastionLabTorch
+from ._utils import compiled_models
 from .optimizer import *
 from .data import RemoteDataset
 
@@ -17,6 +20,86 @@ if TYPE_CHECKING:
     from .data import RemoteDataset
 
 
+def _compilation_key(model: Module, trace_input: List[torch.Tensor]) -> Hashable:
+    """Identifies what a compiled model depends on: the model's submodules and weights
+    (by identity) and the shapes and dtypes of the tracing inputs.
+
+    Identities cannot be reused while the key is cached, as the compiled model
+    keeps the objects alive.
+    """
+    return (
+        tuple(id(m) for m in model.modules()),
+        tuple(id(p) for p in model.parameters()),
+        tuple(id(b) for b in model.buffers()),
+        tuple((tuple(x.shape), x.dtype) for x in trace_input),
+    )
+
+
+# Modules that behave differently in training and evaluation modes
+_MODE_DEPENDENT_MODULES = (
+    torch.nn.modules.dropout._DropoutNd,
+    torch.nn.modules.batchnorm._NormBase,
+)
+
+
+def _compile_model(
+    model: Module, trace_input: List[torch.Tensor]
+) -> torch.jit.ScriptModule:
+    """Compiles a model to TorchScript, with the tracing strategy when possible.
+
+    Tracing is much cheaper than scripting but cannot capture data-dependent control flow.
+    When tracing fails or reports such a control flow (with a `TracerWarning`), the model
+    is scripted instead.
+
+    Tracing also only records the current mode of the model, while the server both trains
+    and tests it: models containing mode-dependent modules (e.g. dropout, batch norm) are
+    scripted first, and only traced if they cannot be scripted.
+    """
+    scripting_error: Optional[Exception] = None
+    mode_dependent = any(
+        isinstance(m, _MODE_DEPENDENT_MODULES) for m in model.modules()
+    )
+    if mode_dependent:
+        try:
+            return torch.jit.script(model)
+        except Exception as e:
+            scripting_error = e
+
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter("always", torch.jit.TracerWarning)
+        try:
+            traced = torch.jit.trace(
+                model, tuple(trace_input), strict=False, check_trace=False
+            )
+        except Exception:
+            traced = None
+    tracer_warnings = [
+        w for w in caught if issubclass(w.category, torch.jit.TracerWarning)
+    ]
+    if traced is not None and len(tracer_warnings) == 0 and not mode_dependent:
+        return traced
+
+    if scripting_error is None:
+        try:
+            return torch.jit.script(model)
+        except Exception as e:
+            scripting_error = e
+    if traced is None:
+        raise scripting_error
+
+    # Fall back on the trace, as imperfect as it may be
+    for w in tracer_warnings:
+        warnings.warn(w.message, w.category)
+    if mode_dependent:
+        mode = "training" if model.training else "evaluation"
+        warnings.warn(
+            f"The model could not be scripted, it is traced in {mode} mode "
+            "and will run in this mode for both training and testing.",
+            torch.jit.TracerWarning,
+        )
+    return traced
+
+
 class RemoteLearner:
     """Represents a remote model on the server along with hyperparameters to train and test it.
 
@@ -62,14 +145,16 @@ class RemoteLearner:
             if expand:
                 expand_weights(model, max_batch_size)
             self.model = model
-            try:
-                model = torch.jit.script(model)
-            except:
-                model = torch.jit.trace(  # Compile the model with the tracing strategy
-                    # Wrapp the model to use the first output only (and drop the others)
-                    model,
-                    [x.unsqueeze(0) for x in remote_dataset._trace_input],
-                )
+            trace_input = [x.unsqueeze(0) for x in remote_dataset._trace_input]
+            key = _compilation_key(model, trace_input)
+            cached = compiled_models.get(model)
+            # Expanded models are modified in place, their compiled version cannot be reused
+            if not expand and cached is not None and cached[0] == key:
+                compiled = cached[1]
+            else:
+                compiled = _compile_model(model, trace_input)
+                compiled_models[model] = (key, compiled)
+            model = compiled
             self.model_ref = client.send_model(
                 model,
                 name=model_name if model_name is not None else model_class_name,
@@ -108,6 +193,9 @@ class RemoteLearner:
         resume: bool = False,
     ) -> TrainConfig:
         batch_size = batch_size if batch_size is not None else self.max_batch_size
+        if metric_eps is None:
+            nb_batches = self.remote_dataset.nb_samples / batch_size
+            metric_eps = self.metric_eps_per_batch * float(nb_epochs) * nb_batches
         return TrainConfig(
             model=self.model_ref,
             dataset=self.remote_dataset.identifier,
@@ -120,11 +208,7 @@ class RemoteLearner:
             resume=resume,
             eps=eps if eps is not None else -1.0,
             max_grad_norm=max_grad_norm if max_grad_norm else self.max_grad_norm,
-            metric_eps=metric_eps
-            if metric_eps
-            else self.metric_eps_per_batch
-            * float(nb_epochs)
-            * float(self.remote_dataset.nb_samples / batch_size),
+            metric_eps=metric_eps,
             **self.optimizer.to_msg_dict(lr),
         )
 
@@ -135,18 +219,22 @@ class RemoteLearner:
         metric_eps: Optional[float] = None,
     ) -> TestConfig:
         batch_size = batch_size if batch_size is not None else self.max_batch_size
+        if metric_eps is None:
+            nb_batches = self.remote_dataset.nb_samples / batch_size
+            metric_eps = self.metric_eps_per_batch * nb_batches
         return TestConfig(
             model=self.model_ref,
             dataset=self.remote_dataset.identifier,
             batch_size=batch_size,
             device=self.device,
             metric=metric if metric is not None else self.loss,
-            metric_eps=metric_eps
-            if metric_eps
-            else self.metric_eps_per_batch
-            * float(self.remote_dataset.nb_samples / batch_size),
+            metric_eps=metric_eps,
         )
 
+    @staticmethod
+    def _tqdm_description(epoch: int, nb_epochs: int, train: bool = True) -> str:
+        return "Epoch {}/{} - {}".format(epoch, nb_epochs, "train" if train else "test")
+
     @staticmethod
     def _new_tqdm_bar(
         epoch: int, nb_epochs: int, nb_batches: int, train: bool = True
@@ -157,85 +245,92 @@ class RemoteLearner:
             bar_format="{l_bar}{bar:20}{r_bar}",
         )
         t.set_description(
-            "Epoch {}/{} - {}".format(epoch, nb_epochs, "train" if train else "test")
+            RemoteLearner._tqdm_description(epoch, nb_epochs, train), refresh=False
         )
         return t
 
+    @staticmethod
+    def _warn_poll_delay(poll_delay: Optional[float]) -> None:
+        if poll_delay is not None:
+            warnings.warn(
+                "poll_delay is deprecated and ignored, metrics are streamed by the server.",
+                DeprecationWarning,
+                stacklevel=3,
+            )
+
     def _poll_metric(
         self,
         run: Reference,
         name: str,
         train: bool = True,
-        timeout: int = 100,
-        poll_delay: float = 0.2,
+        timeout: float = 60.0,
     ) -> None:
-        timeout_counter = 0
-
-        metric = None
-        for _ in range(timeout):
-            try:
-                sleep(poll_delay)
-                metric = self.client.get_metric(run)
-                break
-            except GRPCException as e:
-                if e.code == StatusCode.OUT_OF_RANGE:
-                    continue
-                else:
-                    raise e
-        if metric is None:
-            raise Exception(
-                f"Run start timeout. Polling has stoped. You may query the server by hand later using: run id is {run.identifier}"
-            )
+        metrics = self.client.stream_metric(run)
+        timed_out = Event()
+        stopped = Event()
+        deadline = monotonic() + timeout
 
-        if self.progress:
-            t = RemoteLearner._new_tqdm_bar(
-                metric.epoch + 1, metric.nb_epochs, metric.nb_batches, train
-            )
-            t.update(metric.batch + 1)
-            t.set_postfix(
-                **{name: "{:.4f} (+/- {:.4f})".format(metric.value, metric.uncertainty)}
-            )
-        else:
-            self.log.append(metric)
+        def watchdog() -> None:
+            # A single thread cancels the stream once no update was received for `timeout` seconds
+            while not stopped.wait(max(deadline - monotonic(), 0.0)):
+                if monotonic() >= deadline:
+                    timed_out.set()
+                    metrics.cancel()
+                    return
 
-        while True:
-            sleep(poll_delay)
-            prev_batch = metric.batch
-            prev_epoch = metric.epoch
-            metric = self.client.get_metric(run)
+        Thread(target=watchdog, daemon=True).start()
 
-            # Handle end of training
-            if metric.batch == prev_batch and metric.epoch == prev_epoch:
-                timeout_counter += 1
-            else:
-                timeout_counter = 0
-            if timeout_counter > timeout:
-                break
-
-            if self.progress:
-                # Handle bar update
-                if metric.epoch != prev_epoch:
-                    t = RemoteLearner._new_tqdm_bar(
-                        metric.epoch + 1, metric.nb_epochs, metric.nb_batches, train
-                    )
-                    t.update(metric.batch + 1)
-                else:
-                    t.update(metric.batch - prev_batch)
-                t.set_postfix(
-                    **{
-                        name: "{:.4f} (+/- {:.4f})".format(
-                            metric.value, metric.uncertainty
+        # A single bar is reused (and reset) across epochs
+        t: Optional[tqdm] = None
+        prev_metric = None
+        try:
+            for metric in metrics:
+                deadline = monotonic() + timeout
+                if self.progress:
+                    # Handle bar update
+                    if t is None:
+                        t = RemoteLearner._new_tqdm_bar(
+                            metric.epoch + 1, metric.nb_epochs, metric.nb_batches, train
+                        )
+                        t.update(metric.batch + 1)
+                    elif metric.epoch != prev_metric.epoch:
+                        t.reset(total=metric.nb_batches)
+                        t.set_description(
+                            RemoteLearner._tqdm_description(
+                                metric.epoch + 1, metric.nb_epochs, train
+                            ),
+                            refresh=False,
+                        )
+                        t.update(metric.batch + 1)
+                    else:
+                        t.update(metric.batch - prev_metric.batch)
+                    if (
+                        prev_metric is None
+                        or metric.value != prev_metric.value
+                        or metric.uncertainty != prev_metric.uncertainty
+                    ):
+                        t.set_postfix(
+                            **{
+                                name: "{:.4f} (+/- {:.4f})".format(
+                                    metric.value, metric.uncertainty
+                                )
+                            }
                         )
-                    }
+                else:
+                    self.log.append(metric)
+                prev_metric = metric
+        except RpcError as e:
+            if not timed_out.is_set():
+                raise GRPCException(e)
+            # Polling simply ends when the run stops making progress
+            if prev_metric is None:
+                raise Exception(
+                    f"Run start timeout. Polling has stoped. You may query the server by hand later using: run id is {run.identifier}"
                 )
-            else:
-                self.log.append(metric)
-
-            if (
-                metric.epoch + 1 == metric.nb_epochs
-                and metric.batch + 1 == metric.nb_batches
-            ):
-                break
+        finally:
+            stopped.set()
+            if t is not None:
+                t.close()
 
     def fit(
         self,
@@ -246,7 +341,7 @@ class RemoteLearner:
         lr: Optional[float] = None,
         metric_eps: Optional[float] = None,
         timeout: float = 60.0,
-        poll_delay: float = 0.2,
+        poll_delay: Optional[float] = None,
         per_n_epochs_checkpoint: int = 0,
         per_n_steps_checkpoint: int = 0,
         resume: bool = False,
@@ -262,8 +357,9 @@ class RemoteLearner:
                         the default per-batch budget.
             timeout: Timeout in seconds between two updates of the loss on the server side. When elapsed without updates,
                         polling ends and the progress bar is terminated.
-            poll_delay: Delay in seconds between two polling requests for the loss.
+            poll_delay: Deprecated and ignored, the loss is streamed by the server.
         """
+        RemoteLearner._warn_poll_delay(poll_delay)
         run = self.client._train(
             self._train_config(
                 nb_epochs,
@@ -281,8 +377,7 @@ class RemoteLearner:
             run,
             name=self.loss,
             train=True,
-            timeout=int(timeout / poll_delay),
-            poll_delay=poll_delay,
+            timeout=timeout,
         )
 
     def test(
@@ -291,8 +386,8 @@ class RemoteLearner:
         batch_size: Optional[int] = None,
         metric: Optional[str] = None,
         metric_eps: Optional[float] = None,
-        timeout: int = 100,
-        poll_delay: float = 0.2,
+        timeout: float = 20.0,
+        poll_delay: Optional[float] = None,
     ) -> None:
         """Tests the remote model with the test dataloader provided in the `RemoteLearner`.
 
@@ -303,15 +398,15 @@ class RemoteLearner:
                         the default per-batch budget.
             timeout: Timeout in seconds between two updates of the metric on the server side. When elapsed without updates,
                         polling ends and the progress bar is terminated.
-            poll_delay: Delay in seconds between two polling requests for the metric.
+            poll_delay: Deprecated and ignored, the metric is streamed by the server.
         """
+        RemoteLearner._warn_poll_delay(poll_delay)
         run = self.client._test(self._test_config(batch_size, metric, metric_eps))
         self._poll_metric(
             run,
             name=metric if metric is not None else self.loss,
             train=False,
             timeout=timeout,
-            poll_delay=poll_delay,
         )
 
     def get_model(self) -> Module:
@@ -1,4 +1,6 @@
-from typing import List, Tuple, Optional
+from collections.abc import Sequence
+from typing import List, Tuple, Optional, Union
+import torch
 from torch import Tensor
 from torch.nn import Module
 from torch.utils.data import Dataset
@@ -6,6 +8,31 @@ from torch.utils.data import Dataset
 __pdoc__ = {}
 
 
+class TensorBatch(Sequence):
+    """A batch of samples of a `TensorDataset` stored as stacked columns and labels.
+
+    It behaves as the sequence of samples expected from `Dataset.__getitems__` while
+    letting collate functions aware of it use the stacked tensors directly.
+
+    Args:
+        columns: Tensors that represent the columns of the batch.
+        labels: A tensor containing the labels of the batch.
+    """
+
+    def __init__(self, columns: List[Tensor], labels: Optional[Tensor]) -> None:
+        self.columns = columns
+        self.labels = labels
+
+    def __len__(self) -> int:
+        return len(self.columns[0])
+
+    def __getitem__(self, idx: int) -> Tuple[List[Tensor], Optional[Tensor]]:
+        return (
+            [column[idx] for column in self.columns],
+            self.labels[idx] if self.labels is not None else None,
+        )
+
+
 class TensorDataset(Dataset):
     """A simple dataset compliant with Torch's `Dataset` build upon
     tensors representing columns and labels.
@@ -30,9 +57,25 @@ class TensorDataset(Dataset):
             self.labels[idx] if self.labels is not None else None,
         )
 
+    def __getitems__(
+        self, indices: List[int]
+    ) -> Union[TensorBatch, List[Tuple[List[Tensor], Optional[Tensor]]]]:
+        """Returns the samples at the given indices, gathered with one `index_select` per column.
+
+        Subclasses overriding `__getitem__` get their samples one by one through it.
+        """
+        if type(self).__getitem__ is not TensorDataset.__getitem__:
+            return [self[i] for i in indices]
+        idx = torch.as_tensor(indices, dtype=torch.long)
+        return TensorBatch(
+            [column.index_select(0, idx) for column in self.columns],
+            self.labels.index_select(0, idx) if self.labels is not None else None,
+        )
+
 
 __pdoc__["TensorDataset.__len__"] = True
 __pdoc__["TensorDataset.__getitem__"] = True
+__pdoc__["TensorDataset.__getitems__"] = True
 
 
 class MultipleOutputWrapper(Module):
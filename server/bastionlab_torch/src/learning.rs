@@ -24,6 +24,17 @@ pub enum Run {
     Pending,
 }
 
+/// Ends runs that did not process any batch (e.g. when the dataset is smaller than the batch size),
+/// which would otherwise stay pending forever
+fn mark_empty_run(run: &RwLock<Run>) {
+    let mut run = run.write().unwrap();
+    if let Run::Pending = *run {
+        *run = Run::Error(Status::failed_precondition(
+            "Run did not process any batch, the dataset may be smaller than the batch size",
+        ));
+    }
+}
+
 /// Returns a metric by name from config and computes per step privacy budget for metrics
 fn build_shared_context(
     metric: &str,
@@ -250,6 +261,7 @@ pub fn module_train(
                         }
                     }
                 }
+                mark_empty_run(&run);
                 telemetry::add_event(
                     TelemetryEventProps::TrainerLog {
                         log_type: Some("end_training".to_string()),
@@ -345,6 +357,7 @@ pub fn module_test(
                             Err(e) => Run::Error(e),
                         };
                 }
+                mark_empty_run(&run);
                 telemetry::add_event(
                     TelemetryEventProps::TrainerLog {
                         log_type: Some("end_testing".to_string()),
@@ -5,8 +5,9 @@ use bastionlab_learning::nn::Module;
 use bastionlab_learning::{data::Dataset, nn::CheckPoint};
 use prost::Message;
 use ring::{digest, hmac};
-use std::time::Instant;
-use tch::Tensor;
+use std::time::{Duration, Instant};
+use tch::{Kind, Tensor};
+use tokio::sync::mpsc;
 use tokio_stream::wrappers::ReceiverStream;
 use tonic::{Request, Response, Status, Streaming};
 use uuid::Uuid;
@@ -21,8 +22,8 @@ pub mod bastionlab {
 
 use torch_proto::torch_service_server::TorchService;
 use torch_proto::{
-    Chunk, Devices, Empty, Metric, Optimizers, References, RemoteDatasetReference, TestConfig,
-    TrainConfig, UpdateTensor,
+    Batch, Chunk, Devices, Empty, Metric, Optimizers, References, RemoteDatasetReference,
+    TensorBuffer, TestConfig, TrainConfig, UpdateTensor, UpdateTensors,
 };
 
 use bastionlab::{Reference, TensorMetaData};
@@ -40,6 +41,9 @@ use serialization::*;
 
 use bastionlab_learning::serialization::{BinaryModule, SizedObjectsBytes};
 
+/// Delay between two checks of the state of a run when streaming its metric.
+const METRIC_STREAM_DELAY: Duration = Duration::from_millis(100);
+
 /// The server's state
 #[derive(Clone)]
 pub struct BastionLabTorch {
@@ -120,6 +124,76 @@ impl BastionLabTorch {
         Ok(Arc::clone(tensor))
     }
 
+    /// Converts a stored tensor to the dtype of an [`UpdateTensor`] request.
+    /// Returns `tensor` converted as requested by `update`, leaving `tensor` untouched.
+    fn convert_tensor(tensor: &Tensor, update: &UpdateTensor) -> Result<Tensor, Status> {
+        let kind = get_kind(&update.dtype)?;
+
+        // Casts between int8 and uint8 keep the bits of every value:
+        // the data is reinterpreted (without copy) instead of being converted
+        if matches!(
+            (tensor.kind(), kind),
+            (Kind::Int8, Kind::Uint8) | (Kind::Uint8, Kind::Int8)
+        ) {
+            tcherror_to_status(tensor.f_view_dtype(kind))
+        } else {
+            Ok(tensor.to_dtype(kind, true, true))
+        }
+    }
+
+    fn update_tensor(&self, update: &UpdateTensor) -> Result<Reference, Status> {
+        let mut list = self.update_tensors(std::slice::from_ref(update))?;
+        Ok(list.remove(0))
+    }
+
+    /// Applies all `updates`, or none of them if any fails.
+    fn update_tensors(&self, updates: &[UpdateTensor]) -> Result<Vec<Reference>, Status> {
+        let tensors = self.tensors.read().unwrap();
+
+        // All updated tensors stay locked from their conversion to their replacement.
+        // Locks are taken in identifier order so that concurrent calls cannot deadlock.
+        let mut identifiers: Vec<&str> = updates.iter().map(|u| u.identifier.as_str()).collect();
+        identifiers.sort_unstable();
+        identifiers.dedup();
+        let mut locked = HashMap::with_capacity(identifiers.len());
+        for identifier in identifiers {
+            let tensor = tensors
+                .get(identifier)
+                .ok_or(Status::not_found("Could not find tensor"))?;
+            locked.insert(identifier, tensor.lock().unwrap());
+        }
+
+        // Converted tensors are only swapped in once all conversions have succeeded
+        let mut converted: HashMap<&str, Tensor> = HashMap::new();
+        let mut list = Vec::with_capacity(updates.len());
+        for update in updates {
+            let identifier = update.identifier.as_str();
+
+            // Successive updates of the same tensor apply on top of each other
+            let new_tensor = match converted.get(identifier) {
+                Some(pending) => Self::convert_tensor(pending, update)?,
+                None => Self::convert_tensor(&locked[identifier], update)?,
+            };
+
+            let meta = TensorMetaData {
+                input_dtype: vec![format!("{:?}", new_tensor.kind())],
+                input_shape: new_tensor.size(),
+            };
+            list.push(Reference {
+                identifier: update.identifier.clone(),
+                name: String::new(),
+                description: String::new(),
+                meta: meta.encode_to_vec(),
+            });
+            converted.insert(identifier, new_tensor);
+        }
+
+        for (identifier, new_tensor) in converted {
+            **locked.get_mut(identifier).unwrap() = new_tensor;
+        }
+        Ok(list)
+    }
+
     fn convert_from_remote_dataset_to_dataset(
         &self,
         dataset: RemoteDatasetReference,
@@ -167,6 +241,7 @@ impl BastionLabTorch {
 impl TorchService for BastionLabTorch {
     type FetchDatasetStream = ReceiverStream<Result<Chunk, Status>>;
     type FetchModuleStream = ReceiverStream<Result<Chunk, Status>>;
+    type StreamMetricStream = ReceiverStream<Result<Metric, Status>>;
 
     async fn send_dataset(
         &self,
@@ -179,14 +254,29 @@ impl TorchService for BastionLabTorch {
 
         let artifact: Artifact<SizedObjectsBytes> = unstream_data(request.into_inner()).await?;
 
-        let (dataset_hash, dataset_size) = {
-            let lock = artifact.data.read().unwrap();
-            let data = lock.get();
-            let hash = hex::encode(digest::digest(&digest::SHA256, &data).as_ref());
-            (hash, data.len())
+        let data: Vec<u8> = Arc::try_unwrap(artifact.data)
+            .unwrap()
+            .into_inner()
+            .unwrap()
+            .into();
+        let dataset_size = data.len();
+
+        // The hash is only reported to telemetry: it is computed on a separate
+        // thread while the batches are deserialized instead of before.
+        let (dataset_hash, dataset) = std::thread::scope(|s| {
+            let hash = s.spawn(|| hex::encode(digest::digest(&digest::SHA256, &data).as_ref()));
+            let dataset = dataset_from_batches(&data);
+            (hash.join().unwrap(), dataset)
+        });
+
+        let dataset = Artifact {
+            data: Arc::new(RwLock::new(dataset?)),
+            name: artifact.name,
+            description: artifact.description,
+            secret: artifact.secret,
+            meta: artifact.meta,
+            client_info: artifact.client_info,
         };
-
-        let dataset: Artifact<Dataset> = tcherror_to_status((artifact).deserialize())?;
         let name = dataset.name.clone();
 
         let dataset = self.insert_dataset(dataset);
@@ -273,7 +363,15 @@ impl TorchService for BastionLabTorch {
             let artifact = datasets
                 .get(&identifier)
                 .ok_or(Status::not_found("Dataset not found"))?;
-            tcherror_to_status(artifact.serialize())?
+            let batches = batches_from_dataset(&artifact.data.read().unwrap())?;
+            Artifact {
+                data: Arc::new(RwLock::new(batches)),
+                name: artifact.name.clone(),
+                description: artifact.description.clone(),
+                secret: artifact.secret.clone(),
+                meta: artifact.meta.clone(),
+                client_info: artifact.client_info.clone(),
+            }
         };
 
         Ok(stream_data(serialized, 4_194_285, "Dataset".to_string()).await)
@@ -558,21 +656,62 @@ impl TorchService for BastionLabTorch {
         }
     }
 
+    async fn stream_metric(
+        &self,
+        request: Request<Reference>,
+    ) -> Result<Response<Self::StreamMetricStream>, Status> {
+        let identifier = Uuid::parse_str(&request.into_inner().identifier)
+            .map_err(|_| Status::invalid_argument("Invalid run reference"))?;
+        let run = Arc::clone(
+            self.runs
+                .read()
+                .unwrap()
+                .get(&identifier)
+                .ok_or_else(|| Status::not_found("Run not found"))?,
+        );
+
+        let (tx, rx) = mpsc::channel(16);
+        tokio::spawn(async move {
+            let mut last_step = None;
+            loop {
+                // Only new metrics are sent, the stream ends after the last batch or on error
+                let (update, done) = match &*run.read().unwrap() {
+                    Run::Pending => (None, false),
+                    Run::Ok(m) => (
+                        if last_step != Some((m.epoch, m.batch)) {
+                            last_step = Some((m.epoch, m.batch));
+                            Some(Ok(m.clone()))
+                        } else {
+                            None
+                        },
+                        m.epoch + 1 == m.nb_epochs && m.batch + 1 == m.nb_batches,
+                    ),
+                    Run::Error(e) => (Some(Err(Status::internal(e.message()))), true),
+                };
+                if let Some(update) = update {
+                    if tx.send(update).await.is_err() {
+                        break;
+                    }
+                }
+                // Stop polling once the run is over or the client has cancelled the stream
+                if done || tx.is_closed() {
+                    break;
+                }
+                tokio::time::sleep(METRIC_STREAM_DELAY).await;
+            }
+        });
+
+        Ok(Response::new(ReceiverStream::new(rx)))
+    }
+
     async fn send_tensor(
         &self,
         request: Request<Streaming<Chunk>>,
     ) -> Result<Response<Reference>, Status> {
         let res = unstream_data(request.into_inner()).await?;
 
-        let tensor = {
-            let data = res.data.read().unwrap();
-            let data: Tensor = (&*data).try_into().map_err(|e| {
-                Status::aborted(format!(
-                    "Could not convert SizedObjectBytes into Tensor: {e}"
-                ))
-            })?;
-            data
-        };
+        let tensor =
+            tensor_from_sized_bytes(Arc::try_unwrap(res.data).unwrap().into_inner().unwrap())?;
 
         let (_, reference) = self.insert_tensor(Arc::new(Mutex::new(tensor)));
         Ok(Response::new(reference))
@@ -582,28 +721,15 @@ impl TorchService for BastionLabTorch {
         &self,
         request: Request<UpdateTensor>,
     ) -> Result<Response<Reference>, Status> {
-        let mut tensors = self.tensors.write().unwrap();
-
-        let (identifier, dtype) = (&request.get_ref().identifier, &request.get_ref().dtype);
-
-        let tensor = tensors
-            .get_mut(identifier)
-            .ok_or(Status::not_found("Could not find tensor"))?;
-
-        let mut locked_tensor = tensor.lock().unwrap();
-
-        *locked_tensor = locked_tensor.to_dtype(get_kind(&dtype)?, true, true);
+        Ok(Response::new(self.update_tensor(request.get_ref())?))
+    }
 
-        let meta = TensorMetaData {
-            input_dtype: vec![format!("{:?}", locked_tensor.kind())],
-            input_shape: locked_tensor.size(),
-        };
-        Ok(Response::new(Reference {
-            identifier: identifier.clone(),
-            name: String::new(),
-            description: String::new(),
-            meta: meta.encode_to_vec(),
-        }))
+    async fn modify_tensors(
+        &self,
+        request: Request<UpdateTensors>,
+    ) -> Result<Response<References>, Status> {
+        let list = self.update_tensors(&request.get_ref().list)?;
+        Ok(Response::new(References { list }))
     }
 
     async fn conv_to_dataset(
@@ -1,11 +1,14 @@
-use super::Chunk;
+use super::{Batch, Chunk, TensorBuffer};
 use crate::storage::Artifact;
+use crate::utils::{get_kind, tcherror_to_status};
+use bastionlab_learning::data::Dataset;
 use bastionlab_learning::serialization::SizedObjectsBytes;
 use log::info;
+use prost::Message;
 use ring::hmac;
-use std::sync::{Arc, RwLock};
+use std::sync::{Arc, Mutex, RwLock};
 use std::time::Instant;
-use tch::Device;
+use tch::{Device, Tensor};
 use tokio::sync::mpsc;
 use tokio_stream::{wrappers::ReceiverStream, StreamExt};
 use tonic::{Response, Status};
@@ -99,6 +102,148 @@ pub async fn stream_data(
     Response::new(ReceiverStream::new(rx))
 }
 
+/// Builds a [`tch::Tensor`] from the raw data, shape and kind stored in a [`TensorBuffer`].
+pub fn tensor_from_buffer(buffer: &TensorBuffer) -> Result<Tensor, Status> {
+    let kind = get_kind(&buffer.dtype)?;
+    tcherror_to_status(Tensor::f_of_data_size(&buffer.data, &buffer.shape, kind))
+}
+
+/// Builds a [`tch::Tensor`] from a binary buffer holding a single length-prefixed [`TensorBuffer`].
+pub fn tensor_from_sized_bytes(mut data: SizedObjectsBytes) -> Result<Tensor, Status> {
+    let object = data
+        .next()
+        .ok_or_else(|| Status::invalid_argument("Expected a tensor in stream"))?;
+    let buffer = TensorBuffer::decode(&object[..])
+        .map_err(|e| Status::invalid_argument(format!("Invalid tensor: {}", e)))?;
+    tensor_from_buffer(&buffer)
+}
+
+/// Copies the raw data of a [`tch::Tensor`] into a [`TensorBuffer`].
+pub fn tensor_to_buffer(tensor: &Tensor) -> Result<TensorBuffer, Status> {
+    let tensor = tcherror_to_status(tensor.f_contiguous())?;
+    let kind = tensor.kind();
+    let numel = tensor.numel();
+    let mut data = vec![0u8; numel * kind.elt_size_in_bytes()];
+    tcherror_to_status(tensor.f_copy_data_u8(&mut data, numel))?;
+    Ok(TensorBuffer {
+        data,
+        shape: tensor.size(),
+        dtype: format!("{:?}", kind),
+    })
+}
+
+/// Iterates over the length-prefixed objects of a raw [`SizedObjectsBytes`] buffer
+/// without copying (nor consuming) them.
+fn sized_objects(mut data: &[u8]) -> impl Iterator<Item = Result<&[u8], Status>> {
+    std::iter::from_fn(move || {
+        if data.is_empty() {
+            return None;
+        }
+        if data.len() < 8 {
+            return Some(Err(Status::invalid_argument("Truncated object length")));
+        }
+        let (len, rest) = data.split_at(8);
+        let len = u64::from_le_bytes(len.try_into().unwrap()) as usize;
+        if rest.len() < len {
+            return Some(Err(Status::invalid_argument("Truncated object")));
+        }
+        let (object, rest) = rest.split_at(len);
+        data = rest;
+        Some(Ok(object))
+    })
+}
+
+/// Builds a [`Dataset`] from a binary buffer of length-prefixed [`Batch`] messages.
+///
+/// The columns and labels of all batches are concatenated along the first dimension.
+/// The buffer is only borrowed so that it can be read concurrently (e.g. hashed).
+pub fn dataset_from_batches(data: &[u8]) -> Result<Dataset, Status> {
+    let mut columns: Vec<Vec<Tensor>> = Vec::new();
+    let mut labels: Vec<Tensor> = Vec::new();
+    let mut privacy_limit = -1.0;
+
+    for object in sized_objects(data) {
+        let batch = Batch::decode(object?)
+            .map_err(|e| Status::invalid_argument(format!("Invalid batch: {}", e)))?;
+        if columns.is_empty() {
+            columns.resize_with(batch.columns.len(), Vec::new);
+        } else if columns.len() != batch.columns.len() {
+            return Err(Status::invalid_argument(
+                "All batches must have the same number of columns",
+            ));
+        }
+        for (column, buffer) in columns.iter_mut().zip(batch.columns.iter()) {
+            column.push(tensor_from_buffer(buffer)?);
+        }
+        let batch_labels = batch
+            .labels
+            .as_ref()
+            .ok_or_else(|| Status::invalid_argument("Batch has no labels"))?;
+        labels.push(tensor_from_buffer(batch_labels)?);
+        privacy_limit = batch.privacy_limit;
+    }
+
+    if columns.is_empty() {
+        return Err(Status::invalid_argument(
+            "Dataset must contain at least one column",
+        ));
+    }
+
+    let samples_inputs = columns
+        .iter()
+        .map(|column| {
+            Ok(Arc::new(Mutex::new(tcherror_to_status(Tensor::f_cat(
+                column, 0,
+            ))?)))
+        })
+        .collect::<Result<Vec<_>, Status>>()?;
+    let labels = Arc::new(Mutex::new(tcherror_to_status(Tensor::f_cat(&labels, 0))?));
+    let privacy_limit = if privacy_limit < 0.0 {
+        -1.0
+    } else {
+        privacy_limit
+    };
+
+    Ok(Dataset::new(samples_inputs, labels, privacy_limit))
+}
+
+/// Number of samples per [`Batch`] when a dataset is sent back to a client.
+const FETCH_BATCH_SIZE: i64 = 1024;
+
+/// Converts a [`Dataset`] into a binary buffer of length-prefixed [`Batch`] messages
+/// holding at most [`FETCH_BATCH_SIZE`] samples each.
+pub fn batches_from_dataset(dataset: &Dataset) -> Result<SizedObjectsBytes, Status> {
+    let columns: Vec<_> = dataset
+        .samples_inputs
+        .iter()
+        .map(|input| input.lock().unwrap())
+        .collect();
+    let labels = dataset.labels.lock().unwrap();
+    let nb_samples = labels.size()[0];
+
+    let mut batches = SizedObjectsBytes::new();
+    let mut start = 0;
+    while start < nb_samples {
+        let length = FETCH_BATCH_SIZE.min(nb_samples - start);
+        let batch = Batch {
+            columns: columns
+                .iter()
+                .map(|column| {
+                    tensor_to_buffer(&tcherror_to_status(column.f_narrow(0, start, length))?)
+                })
+                .collect::<Result<Vec<_>, Status>>()?,
+            labels: Some(tensor_to_buffer(&tcherror_to_status(
+                labels.f_narrow(0, start, length),
+            )?)?),
+            privacy_limit: -1.0,
+        };
+        batches.append_back(batch.encode_to_vec());
+        start += length;
+    }
+
+    Ok(batches)
+}
+
 /// Parses a device string and returns a [`tch::Device`] object if the string is a valid device name.
 pub fn parse_device(device: &str) -> Result<Device, Status> {
     Ok(match device {
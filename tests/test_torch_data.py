@@ -0,0 +1,138 @@
+import unittest
+from types import SimpleNamespace
+import torch
+from bastionlab.client import Client
+from bastionlab.pb.bastionlab_pb2 import (
+    Reference,
+    TensorMetaData,
+)
+from bastionlab.pb.bastionlab_torch_pb2 import (
+    References,
+    UpdateTensor,
+    UpdateTensors,
+)
+from bastionlab.torch.data import (
+    RemoteDataset,
+    RemoteTensor,
+    _tracer,
+)
+
+
+class TestingTracer(unittest.TestCase):
+    def setUp(self):
+        self.dtypes = [torch.float, torch.int64, torch.float, torch.int8]
+        self.shapes = [torch.Size([10, n]) for n in [3, 4, 5, 6]]
+
+    def test_tracer(self):
+        inputs = _tracer(self.dtypes, self.shapes)
+        self.assertEqual([x.dtype for x in inputs], self.dtypes)
+        self.assertEqual([tuple(x.shape) for x in inputs], [(3,), (4,), (5,), (6,)])
+        # Integers remain valid indices
+        self.assertFalse(inputs[1].any())
+        self.assertFalse(inputs[3].any())
+
+    def test_no_overlap(self):
+        inputs = _tracer(self.dtypes, self.shapes)
+        other = inputs[2].clone()
+        inputs[0].fill_(float("nan"))
+        self.assertTrue(torch.equal(inputs[2], other))
+
+    def test_fresh_inputs(self):
+        first = _tracer(self.dtypes, self.shapes)
+        first[1].fill_(1)
+        second = _tracer(self.dtypes, self.shapes)
+        self.assertFalse(second[1].any())
+
+
+class FakeTorchStub:
+    """Records the requests it receives and answers with the converted tensors' metadata."""
+
+    def __init__(self, shapes):
+        self.shapes = shapes
+        self.requests = []
+
+    def reference(self, update):
+        meta = TensorMetaData(
+            input_dtype=[update.dtype], input_shape=self.shapes[update.identifier]
+        )
+        return Reference(
+            identifier=update.identifier,
+            name="",
+            description="",
+            meta=meta.SerializeToString(),
+        )
+
+    def ModifyTensor(self, update):
+        self.requests.append(update)
+        return self.reference(update)
+
+    def ModifyTensors(self, updates):
+        self.requests.append(updates)
+        return References(list=[self.reference(update) for update in updates.list])
+
+
+def make_client(stub):
+    # Main client whose torch client only holds the stub
+    client = Client.__new__(Client)
+    client._bastionlab_torch = SimpleNamespace(stub=stub)
+    return client
+
+
+class TestingRemoteTensor(unittest.TestCase):
+    def test_to(self):
+        stub = FakeTorchStub({"t": [4, 2]})
+        tensor = RemoteTensor(make_client(stub), "t", torch.int8, torch.Size([4, 2]))
+        res = tensor.to(torch.uint8)
+        # The server decides how to convert from the tensor it stores
+        self.assertEqual(stub.requests, [UpdateTensor(identifier="t", dtype="Uint8")])
+        self.assertEqual((res.identifier, res.dtype), ("t", torch.uint8))
+        self.assertEqual(res.shape, torch.Size([4, 2]))
+
+
+class TestingRemoteDataset(unittest.TestCase):
+    def setUp(self):
+        self.stub = FakeTorchStub({"a": [10, 3], "b": [10, 2], "l": [10]})
+        client = make_client(self.stub)
+        self.dataset = RemoteDataset(
+            [
+                RemoteTensor(client, "a", torch.float, torch.Size([10, 3])),
+                RemoteTensor(client, "b", torch.int64, torch.Size([10, 2])),
+            ],
+            RemoteTensor(client, "l", torch.int64, torch.Size([10])),
+            name="name",
+            description="description",
+            identifier="dataset",
+        )
+
+    def test_to(self):
+        res = self.dataset.to(torch.double)
+        (request,) = self.stub.requests
+        self.assertIsInstance(request, UpdateTensors)
+        self.assertEqual(
+            [(update.identifier, update.dtype) for update in request.list],
+            [("a", "Double"), ("b", "Double")],
+        )
+        self.assertEqual([x.identifier for x in res.inputs], ["a", "b"])
+        self.assertEqual([x.dtype for x in res.inputs], [torch.double] * 2)
+        self.assertEqual(
+            [x.shape for x in res.inputs], [torch.Size([10, 3]), torch.Size([10, 2])]
+        )
+        self.assertIs(res.labels, self.dataset.labels)
+        self.assertEqual(
+            (res.name, res.description, res.identifier),
+            ("name", "description", "dataset"),
+        )
+
+    def test_to_with_labels(self):
+        res = self.dataset.to(torch.double, labels_dtype=torch.float)
+        (request,) = self.stub.requests
+        self.assertEqual(
+            [(update.identifier, update.dtype) for update in request.list],
+            [("a", "Double"), ("b", "Double"), ("l", "Float")],
+        )
+        self.assertEqual(res.labels.identifier, "l")
+        self.assertEqual(res.labels.dtype, torch.float)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,72 @@
+import unittest
+import torch
+from torch import nn
+from bastionlab.torch.learner import _compile_model
+
+
+class Linear(nn.Module):
+    def __init__(self) -> None:
+        super().__init__()
+        self.fc = nn.Linear(4, 3)
+
+    def forward(self, x):
+        return self.fc(x)
+
+
+class ControlFlow(Linear):
+    def forward(self, x):
+        if x.sum() > 0:
+            return self.fc(x)
+        return -self.fc(x)
+
+
+class WithDropout(Linear):
+    def __init__(self) -> None:
+        super().__init__()
+        self.dropout = nn.Dropout(0.5)
+
+    def forward(self, x):
+        return self.dropout(self.fc(x))
+
+
+class UnscriptableDropout(WithDropout):
+    def forward(self, x, *args):
+        return self.dropout(self.fc(x))
+
+
+class TestingCompileModel(unittest.TestCase):
+    def setUp(self):
+        self.x = torch.randn(2, 4)
+
+    def test_traced(self):
+        model = Linear()
+        res = _compile_model(model, [self.x])
+        self.assertIsInstance(res, torch.jit.TopLevelTracedModule)
+        self.assertTrue(torch.allclose(res(self.x), model(self.x)))
+
+    def test_control_flow_scripted(self):
+        model = ControlFlow()
+        res = _compile_model(model, [self.x])
+        self.assertIsInstance(res, torch.jit.RecursiveScriptModule)
+        self.assertNotIsInstance(res, torch.jit.TopLevelTracedModule)
+        for x in [self.x.abs(), -self.x.abs()]:
+            self.assertTrue(torch.allclose(res(x), model(x)))
+
+    def test_mode_dependent_scripted(self):
+        model = WithDropout()
+        res = _compile_model(model, [self.x])
+        self.assertNotIsInstance(res, torch.jit.TopLevelTracedModule)
+
+        # Dropout is still disabled in evaluation mode
+        res.eval()
+        model.eval()
+        self.assertTrue(torch.allclose(res(self.x), model(self.x)))
+
+    def test_mode_dependent_unscriptable(self):
+        with self.assertWarnsRegex(torch.jit.TracerWarning, "traced in training mode"):
+            res = _compile_model(UnscriptableDropout(), [self.x])
+        self.assertIsInstance(res, torch.jit.TopLevelTracedModule)
+
+
+if __name__ == "__main__":
+    unittest.main()
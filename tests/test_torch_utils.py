@@ -0,0 +1,314 @@
+import threading
+import time
+import unittest
+import torch
+from torch import nn
+from torch.utils.data import Dataset
+from bastionlab.pb.bastionlab_torch_pb2 import (
+    Chunk,
+    TensorBuffer,
+)
+from bastionlab.torch._utils import (
+    SIZE_LEN,
+    TCH_KINDS,
+    compiled_models,
+    dataset_from_chunks,
+    deserialize_weights_to_model,
+    encode_varint,
+    prefetch,
+    serialize_dataset,
+    stream_artifacts,
+    stream_tensor_buffer,
+    unstream_artifacts,
+)
+from bastionlab.torch.utils import TensorDataset
+
+
+def write_bytes(data, buff):
+    buff.write(data)
+
+
+def frame(data):
+    return len(data).to_bytes(SIZE_LEN, byteorder="little") + data
+
+
+def roundtrip(artifacts, chunk_size):
+    chunks = [
+        chunk
+        for _, chunk in stream_artifacts(
+            iter(artifacts), chunk_size, serialization_fn=write_bytes
+        )
+    ]
+    objects = list(
+        unstream_artifacts(iter(chunks), deserialization_fn=lambda b: b.getvalue())
+    )
+    return chunks, objects
+
+
+class TestingStreamArtifacts(unittest.TestCase):
+    def test_empty(self):
+        chunks, objects = roundtrip([], 16)
+        self.assertEqual(chunks, [b""])
+        self.assertEqual(objects, [])
+
+    def test_empty_artifact(self):
+        chunks, objects = roundtrip([b""], 16)
+        self.assertEqual(b"".join(chunks), frame(b""))
+        self.assertEqual(objects, [b""])
+
+    def test_single_chunk(self):
+        artifacts = [b"a", b"bc", b"def"]
+        chunks, objects = roundtrip(artifacts, 1024)
+        self.assertEqual(len(chunks), 1)
+        self.assertEqual(objects, artifacts)
+
+    def test_multiple_chunks(self):
+        artifacts = [bytes([i]) * (i * 7) for i in range(20)]
+        chunks, objects = roundtrip(artifacts, 10)
+        self.assertTrue(all(len(chunk) == 10 for chunk in chunks[:-1]))
+        self.assertLessEqual(len(chunks[-1]), 10)
+        self.assertEqual(objects, artifacts)
+
+    def test_framing(self):
+        chunks, _ = roundtrip([b"abc", b"de"], 1024)
+        self.assertEqual(chunks[0], frame(b"abc") + frame(b"de"))
+
+    def test_tensors(self):
+        tensors = [torch.arange(i * 100, dtype=torch.float) for i in range(5)]
+        chunks = [chunk for _, chunk in stream_artifacts(iter(tensors), 256)]
+        objects = list(unstream_artifacts(iter(chunks)))
+        self.assertEqual(len(objects), len(tensors))
+        for obj, tensor in zip(objects, tensors):
+            self.assertTrue(torch.equal(obj, tensor))
+
+    def test_truncated(self):
+        chunks, _ = roundtrip([b"abc", b"de"], 4)
+        data = b"".join(chunks)
+        for end in [SIZE_LEN - 1, SIZE_LEN + 1, len(data) - 1]:
+            with self.assertRaisesRegex(ValueError, "truncated stream"):
+                list(
+                    unstream_artifacts(
+                        iter([data[:end]]), deserialization_fn=lambda b: b.getvalue()
+                    )
+                )
+
+
+class TestingPrefetch(unittest.TestCase):
+    def test_order(self):
+        self.assertEqual(list(prefetch(iter(range(100)), size=3)), list(range(100)))
+
+    def test_exception(self):
+        def failing():
+            yield 1
+            yield 2
+            raise ValueError("failure")
+
+        res = []
+        with self.assertRaisesRegex(ValueError, "failure"):
+            for x in prefetch(failing()):
+                res.append(x)
+        self.assertEqual(res, [1, 2])
+
+    def test_early_close(self):
+        produced = []
+
+        def infinite():
+            i = 0
+            while True:
+                produced.append(i)
+                yield i
+                i += 1
+
+        nb_threads = threading.active_count()
+        it = prefetch(infinite(), size=2)
+        self.assertEqual([next(it) for _ in range(3)], [0, 1, 2])
+        it.close()
+
+        # The producer thread stops once the consumer is closed
+        deadline = time.monotonic() + 5.0
+        while threading.active_count() > nb_threads and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(threading.active_count(), nb_threads)
+        self.assertLessEqual(len(produced), 3 + 2 + 1)
+
+
+class TestingTensorBuffer(unittest.TestCase):
+    def test_encode_varint(self):
+        cases = {
+            0: b"\x00",
+            1: b"\x01",
+            127: b"\x7f",
+            128: b"\x80\x01",
+            300: b"\xac\x02",
+            2**32: b"\x80\x80\x80\x80\x10",
+        }
+        for value, encoded in cases.items():
+            self.assertEqual(encode_varint(value), encoded)
+
+    def parse(self, chunks):
+        data = b"".join(chunks)
+        size = int.from_bytes(data[:SIZE_LEN], byteorder="little")
+        self.assertEqual(size, len(data) - SIZE_LEN)
+        return TensorBuffer.FromString(data[SIZE_LEN:])
+
+    def check_roundtrip(self, tensor, chunk_size):
+        buffer = self.parse(list(stream_tensor_buffer(tensor, chunk_size)))
+        self.assertEqual(buffer.dtype, TCH_KINDS[tensor.dtype])
+        self.assertEqual(list(buffer.shape), list(tensor.shape))
+        self.assertEqual(
+            buffer.data,
+            tensor.contiguous().reshape(-1).view(torch.uint8).numpy().tobytes(),
+        )
+
+    def test_stream_tensor_buffer(self):
+        tensor = torch.randn(37, 5)
+        for chunk_size in [1, 7, 64, 4096, 1_000_000]:
+            self.check_roundtrip(tensor, chunk_size)
+
+    def test_chunk_sizes(self):
+        chunks = list(stream_tensor_buffer(torch.zeros(1000, dtype=torch.uint8), 64))
+        self.assertTrue(all(len(chunk) == 64 for chunk in chunks[:-1]))
+
+    def test_dtypes(self):
+        for dtype in [torch.uint8, torch.int32, torch.int64, torch.double, torch.bool]:
+            self.check_roundtrip(torch.ones(3, 4, dtype=dtype), 16)
+
+    def test_empty(self):
+        self.check_roundtrip(torch.zeros(0, 3), 16)
+
+    def test_non_contiguous(self):
+        self.check_roundtrip(
+            torch.arange(60, dtype=torch.float).reshape(6, 10)[:, ::3], 16
+        )
+
+
+class TestingSerializeDataset(unittest.TestCase):
+    def setUp(self):
+        self.columns = [torch.arange(20).reshape(10, 2), torch.randn(10, 3)]
+        self.labels = torch.arange(10)
+
+    def check_roundtrip(self, dataset, **kwargs):
+        res = dataset_from_chunks(
+            serialize_dataset(dataset, "name", "description", batch_size=4, **kwargs)
+        )
+        self.assertEqual(len(res.columns), len(self.columns))
+        for column, expected in zip(res.columns, self.columns):
+            self.assertEqual(column.dtype, expected.dtype)
+            self.assertTrue(torch.equal(column, expected))
+        self.assertTrue(torch.equal(res.labels, self.labels))
+
+    def test_roundtrip(self):
+        self.check_roundtrip(TensorDataset(self.columns, self.labels))
+
+    def test_roundtrip_small_chunks(self):
+        self.check_roundtrip(TensorDataset(self.columns, self.labels), chunk_size=64)
+
+    def test_dataset_without_len(self):
+        columns, labels = self.columns, self.labels
+
+        class Legacy(Dataset):
+            def __getitem__(self, idx):
+                if idx >= len(labels):
+                    raise IndexError(idx)
+                return [column[idx] for column in columns], labels[idx]
+
+        self.check_roundtrip(Legacy(), num_workers=2)
+
+
+class TestingTensorDataset(unittest.TestCase):
+    def setUp(self):
+        self.columns = [torch.arange(20).reshape(10, 2), torch.randn(10, 3)]
+        self.labels = torch.arange(10)
+
+    def check_getitems(self, dataset, indices):
+        batch = dataset.__getitems__(indices)
+        self.assertEqual(len(batch), len(indices))
+        for sample, idx in zip(batch, indices):
+            columns, label = sample
+            expected_columns, expected_label = dataset[idx]
+            self.assertEqual(len(columns), len(expected_columns))
+            for column, expected in zip(columns, expected_columns):
+                self.assertTrue(torch.equal(column, expected))
+            if expected_label is None:
+                self.assertIsNone(label)
+            else:
+                self.assertTrue(torch.equal(label, expected_label))
+
+    def test_getitems(self):
+        self.check_getitems(TensorDataset(self.columns, self.labels), [3, 0, 9, 3])
+
+    def test_getitems_without_labels(self):
+        self.check_getitems(TensorDataset(self.columns, None), [1, 2])
+
+    def test_getitems_overridden_getitem(self):
+        class TransformedDataset(TensorDataset):
+            def __getitem__(self, idx):
+                columns, label = super().__getitem__(idx)
+                return [column * 2 for column in columns], label
+
+        self.check_getitems(TransformedDataset(self.columns, self.labels), [4, 7])
+
+
+class Net(nn.Module):
+    def __init__(self) -> None:
+        super().__init__()
+        self.fc = nn.Linear(3, 2)
+        self.seq = nn.Sequential(nn.Linear(2, 2), nn.ReLU(), nn.Linear(2, 1))
+        self.scale = nn.Parameter(torch.ones(1))
+
+    def forward(self, x):
+        return self.seq(self.fc(x)) * self.scale
+
+
+class Weights(nn.Module):
+    """Holds weights named the way the server names them."""
+
+    def __init__(self, weights) -> None:
+        super().__init__()
+        for name, value in weights.items():
+            self.register_parameter(name, nn.Parameter(value))
+
+    def forward(self, x):
+        return x
+
+
+def weights_chunks(weights):
+    return [
+        Chunk(data=chunk)
+        for _, chunk in stream_artifacts(
+            iter([torch.jit.script(Weights(weights))]), 64, torch.jit.save
+        )
+    ]
+
+
+class TestingDeserializeWeights(unittest.TestCase):
+    def test_names(self):
+        model = Net()
+        weights = {
+            name.replace(".", "_"): torch.full_like(p, float(i))
+            for i, (name, p) in enumerate(model.named_parameters())
+        }
+        self.assertIn("seq_0_weight", weights)
+        self.assertIn("scale", weights)
+
+        deserialize_weights_to_model(model, iter(weights_chunks(weights)))
+        for name, p in model.named_parameters():
+            self.assertIsInstance(p, nn.Parameter)
+            self.assertTrue(torch.equal(p.data, weights[name.replace(".", "_")]))
+
+    def test_unknown_weight(self):
+        chunks = weights_chunks({"unknown": torch.zeros(1)})
+        with self.assertRaisesRegex(Exception, "Unknown weight unknown"):
+            deserialize_weights_to_model(Net(), iter(chunks))
+
+    def test_invalidates_compiled_model(self):
+        model = Net()
+        compiled_models[model] = (None, torch.jit.script(model))
+        deserialize_weights_to_model(
+            model, iter(weights_chunks({"scale": torch.zeros(1)}))
+        )
+        self.assertNotIn(model, compiled_models)
+
+
+if __name__ == "__main__":
+    unittest.main()